@@ -4,8 +4,15 @@ Free to use, premium features for subscribers
 """
 import streamlit as st
 import fitz  # PyMuPDF
-import re
+import numpy as np
+import hashlib
 import io
+import threading
+import time
+from collections import defaultdict
+
+# Scanning lives in its own module so worker processes can import it by name
+from pii_scan import PREMIUM_TYPES, find_pii_in_pdf
 
 # Page config
 st.set_page_config(
@@ -93,40 +100,42 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# PII patterns for detection
-PII_PATTERNS = {
-    "SSN (Full)": r"\b\d{3}-\d{2}-\d{4}\b",
-    "SSN (Partial)": r"\b[X*]{3,5}-?[X*]{2}-?\d{4}\b|\b\d{3}-?[X*]{2}-?[X*]{4}\b",
-    "SSN (Last 4)": r"\b(?:SSN|SS#?|Social)[\s:]*[X*]*\d{4}\b",
-    "Date of Birth": r"\b(?:DOB|Date of Birth|Birth Date|Born)[\s:]*\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b",
-    "Date (MM/DD/YYYY)": r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b",
-    "Driver's License": r"\b(?:DL|Driver'?s?\s*License|License\s*#?)[\s:]*[A-Z]?\d{6,12}\b",
-    "Phone Number": r"\b(?:\+?1[-.\s]?)?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}\b",
-    "Email": r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b",
-    "Account Number": r"\b(?:Account|Acct)[\s#:]*[X*]*\d{4,}\b|\b[X*]{4,}\d{4}\b",
-}
-
-# Premium-only patterns
-PREMIUM_PATTERNS = {
-    "Street Address": r"\b\d{1,5}\s+\w+\s+(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct|Way|Circle|Cir)\b",
-    "Zip Code": r"\b\d{5}(?:-\d{4})?\b",
-    "Credit Card": r"\b(?:\d{4}[-\s]?){3}\d{4}\b",
-}
-
 # ============ AUTH FUNCTIONS ============
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_user_tier(user_id):
-    """Fetch user's subscription tier from database"""
+    """Fetch user's subscription tier from database (lookup errors propagate so they're never cached)"""
     if not supabase:
         return "free"
-    try:
-        result = supabase.table("users").select("tier").eq("id", str(user_id)).execute()
-        if result.data and len(result.data) > 0:
-            return result.data[0].get("tier", "free")
-    except:
-        pass
+    result = supabase.table("users").select("tier").eq("id", str(user_id)).execute()
+    if result.data and len(result.data) > 0:
+        return result.data[0].get("tier", "free")
     return "free"
 
+# After checkout, how long to keep re-reading the tier while Stripe's webhook updates it
+UPGRADE_PENDING_SECONDS = 300
+
+def upgrade_pending():
+    return st.session_state.get("upgrade_pending_until", 0) > time.time()
+
+def load_user_tier(user_id):
+    """Return the session's tier, falling back to free for this run only if the lookup fails.
+    Just after checkout it's re-read every run, and only kept once it shows premium."""
+    pending = upgrade_pending()
+    if pending or "tier" not in st.session_state:
+        if pending:
+            get_user_tier.clear(user_id)
+        try:
+            tier = get_user_tier(user_id)
+        except Exception:
+            st.warning("⚠️ Couldn't check your subscription right now, so premium features are off until it can be verified.")
+            return "free"
+        if pending and tier != "premium":
+            return tier
+        st.session_state.pop("upgrade_pending_until", None)
+        st.session_state.tier = tier
+    return st.session_state.tier
+
 def create_user_record(user_id, email):
     """Create user record in database if it doesn't exist"""
     if not supabase:
@@ -164,76 +173,93 @@ def create_checkout_session(email, user_id):
 
 # ============ PDF FUNCTIONS ============
 
-def find_pii_in_text(text, include_premium=False):
-    """Find all PII matches in text"""
-    patterns = PII_PATTERNS.copy()
-    if include_premium:
-        patterns.update(PREMIUM_PATTERNS)
-    
-    matches = []
-    for pii_type, pattern in patterns.items():
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            matches.append({
-                "type": pii_type,
-                "text": match.group(),
-                "start": match.start(),
-                "end": match.end()
-            })
-    return matches
-
-def find_pii_in_pdf(pdf_bytes, include_premium=False):
-    """Find all PII in a PDF document"""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    all_matches = []
-    
-    for page_num, page in enumerate(doc):
-        text = page.get_text()
-        matches = find_pii_in_text(text, include_premium)
-        for match in matches:
-            match["page"] = page_num + 1
-            rects = page.search_for(match["text"])
-            match["rects"] = rects
-            all_matches.append(match)
-    
-    doc.close()
-    return all_matches
+@st.cache_data(show_spinner=False, max_entries=16, ttl=600)
+def _find_pii_cached(pdf_hash, _pdf_bytes, include_premium=False):
+    """find_pii_in_pdf memoized on the PDF's content hash rather than its bytes.
+    Results hold the extracted PII, so only a few are kept, and only briefly."""
+    return find_pii_in_pdf(_pdf_bytes, include_premium)
 
-def redact_pdf(pdf_bytes, items_to_redact):
-    """Apply redactions to PDF"""
+def redact_pdf(pdf_bytes, items_to_redact, garbage_level=1):
+    """Apply redactions to PDF; garbage_level=4 trades save time for a smaller file"""
     doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     
+    # apply_redactions rewrites the page's content stream, so do it once per page
+    by_page = defaultdict(list)
     for item in items_to_redact:
-        page = doc[item["page"] - 1]
-        for rect in item["rects"]:
+        by_page[item["page"] - 1].extend(item["rects"])
+    
+    for page_num, rects in by_page.items():
+        page = doc[page_num]
+        for rect in rects:
             page.add_redact_annot(rect, fill=(0, 0, 0))
         page.apply_redactions()
     
+    # garbage >= 1 still drops the unreferenced pre-redaction content streams
+    save_opts = {"garbage": garbage_level, "deflate": True}
+    if garbage_level >= 4:
+        save_opts.update(deflate_images=True, deflate_fonts=True)
+    
     output = io.BytesIO()
-    doc.save(output, garbage=4, deflate=True)
+    doc.save(output, **save_opts)
     doc.close()
     output.seek(0)
     return output.getvalue()
 
-def render_pdf_preview(pdf_bytes, page_num=0, highlights=None):
-    """Render a PDF page as image with optional highlights"""
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+@st.cache_data(show_spinner=False, max_entries=32, ttl=600)
+def render_pdf_preview(pdf_hash, _pdf_bytes, page_num=0, highlight_rects=(), scale=1.0, fmt="jpeg"):
+    """Render a PDF page as image with the given rects highlighted.
+    Rendered pages show the PII, so like scan results they're only kept briefly."""
+    doc = fitz.open(stream=_pdf_bytes, filetype="pdf")
     page = doc[page_num]
     
-    if highlights:
-        for h in highlights:
-            if h.get("page") == page_num + 1:
-                for rect in h.get("rects", []):
-                    page.draw_rect(rect, color=(1, 1, 0), fill=(1, 1, 0), fill_opacity=0.3)
+    for rect in highlight_rects:
+        page.draw_rect(rect, color=(1, 1, 0), fill=(1, 1, 0), fill_opacity=0.3)
     
-    mat = fitz.Matrix(1.5, 1.5)
-    pix = page.get_pixmap(matrix=mat)
-    img_bytes = pix.tobytes("png")
-    page_count = doc.page_count
+    mat = fitz.Matrix(scale, scale)
+    pix = page.get_pixmap(matrix=mat, alpha=False)
+    if fmt == "jpeg":
+        img_bytes = pix.tobytes("jpeg", jpg_quality=75)
+    else:
+        img_bytes = pix.tobytes(fmt)
     doc.close()
-    return img_bytes, page_count
+    return img_bytes
 
 # ============ MAIN APP ============
 
+def _start_scan(pdf_hash, pdf_bytes, include_premium=False):
+    """Scan in the background so the preview shows up straight away"""
+    scan = {"done": False}
+    threading.Thread(target=_scan_worker, args=(scan, pdf_hash, pdf_bytes, include_premium), daemon=True).start()
+    st.session_state.scan = scan
+
+def _scan_worker(scan, pdf_hash, pdf_bytes, include_premium=False):
+    """Background scan; results go into the scan dict since session state is off-limits to other threads"""
+    try:
+        scan["matches"] = _find_pii_cached(pdf_hash, pdf_bytes, include_premium)
+    except Exception as e:
+        scan["error"] = e
+    scan["done"] = True
+
+def _add_matches(new_matches):
+    """Append matches to session state, keeping the parallel arrays in step"""
+    st.session_state.matches.extend(new_matches)
+    st.session_state.match_types = np.append(
+        st.session_state.match_types, np.array([m["type"] for m in new_matches], dtype=str)
+    )
+    st.session_state.match_pages = np.append(
+        st.session_state.match_pages, np.array([m["page"] for m in new_matches], dtype=np.int32)
+    )
+    st.session_state.selected_mask = np.append(
+        st.session_state.selected_mask, np.ones(len(new_matches), dtype=bool)
+    )
+
+@st.fragment(run_every=0.5)
+def _poll_scan():
+    """Show scan progress, rerunning the whole app once the background scan finishes"""
+    if st.session_state.scan["done"]:
+        st.rerun()
+    st.info("🔍 Scanning for sensitive information...")
+
 def show_redactor_app(is_premium=False, user=None):
     """Display the main PDF redactor app"""
     
@@ -246,13 +272,31 @@ def show_redactor_app(is_premium=False, user=None):
     
     if uploaded_file:
         pdf_bytes = uploaded_file.read()
+        pdf_hash = hashlib.blake2b(pdf_bytes, digest_size=16).digest()
         
         # Store in session state
-        if "pdf_bytes" not in st.session_state or st.session_state.get("filename") != uploaded_file.name:
+        if st.session_state.get("pdf_hash") != pdf_hash:
             st.session_state.pdf_bytes = pdf_bytes
+            st.session_state.pdf_hash = pdf_hash
             st.session_state.filename = uploaded_file.name
-            st.session_state.matches = find_pii_in_pdf(pdf_bytes, include_premium=is_premium)
-            st.session_state.selected = {i: True for i in range(len(st.session_state.matches))}
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            st.session_state.total_pages = doc.page_count
+            doc.close()
+            # Matches stay a list of dicts; type, page and selection are kept as
+            # parallel arrays so per-rerun filtering and counting is vectorized
+            st.session_state.matches = []
+            st.session_state.match_types = np.array([], dtype=str)
+            st.session_state.match_pages = np.array([], dtype=np.int32)
+            st.session_state.selected_mask = np.array([], dtype=bool)
+            # casefold()ed manual text -> indices of the matches it added
+            st.session_state.manual_texts = {}
+            _start_scan(pdf_hash, pdf_bytes, is_premium)
+        
+        # A failed scan stays in session state so it's never shown as "no PII found"
+        scan = st.session_state.scan
+        if scan is not None and scan["done"] and "error" not in scan:
+            st.session_state.scan = None
+            _add_matches(scan["matches"])
         
         matches = st.session_state.matches
         
@@ -262,73 +306,86 @@ def show_redactor_app(is_premium=False, user=None):
         with col1:
             st.subheader("📄 Document Preview")
             
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            total_pages = doc.page_count
-            doc.close()
-            
+            total_pages = st.session_state.total_pages
             if total_pages > 1:
                 page_num = st.slider("Page", 1, total_pages, 1) - 1
             else:
                 page_num = 0
             
-            highlights = [m for m in matches if m["page"] == page_num + 1 and st.session_state.selected.get(matches.index(m), True)]
+            on_page = (st.session_state.match_pages == page_num + 1) & st.session_state.selected_mask
+            highlights = [matches[i] for i in np.flatnonzero(on_page)]
             
-            img_bytes, _ = render_pdf_preview(pdf_bytes, page_num, highlights)
+            highlight_rects = tuple(sorted(tuple(r) for h in highlights for r in h["rects"]))
+            if st.checkbox("High-res preview", help="Render at 1.5x as lossless PNG (slower)"):
+                img_bytes = render_pdf_preview(pdf_hash, pdf_bytes, page_num, highlight_rects, scale=1.5, fmt="png")
+            else:
+                img_bytes = render_pdf_preview(pdf_hash, pdf_bytes, page_num, highlight_rects)
             st.image(img_bytes, use_container_width=True)
         
         with col2:
+            if scan is not None and "error" in scan:
+                st.error(f"Scanning failed, so this document has not been checked for sensitive information: {scan['error']}")
+                if st.button("🔄 Retry scan"):
+                    _start_scan(pdf_hash, pdf_bytes, is_premium)
+                    st.rerun()
+                return
+            if st.session_state.scan is not None:
+                _poll_scan()
+                return
+            
             st.subheader(f"🔍 Found {len(matches)} Potential PII Items")
             
             if matches:
-                by_type = {}
-                for i, m in enumerate(matches):
-                    t = m["type"]
-                    if t not in by_type:
-                        by_type[t] = []
-                    by_type[t].append((i, m))
+                types = st.session_state.match_types
+                # Unique types in order of first appearance
+                unique_types, first_idx = np.unique(types, return_index=True)
                 
                 scol1, scol2, scol3 = st.columns(3)
                 with scol1:
                     if st.button("✅ Select All"):
-                        st.session_state.selected = {i: True for i in range(len(matches))}
+                        st.session_state.selected_mask[:] = True
                         st.rerun()
                 with scol2:
                     if st.button("❌ Clear All"):
-                        st.session_state.selected = {i: False for i in range(len(matches))}
+                        st.session_state.selected_mask[:] = False
                         st.rerun()
                 with scol3:
-                    selected_count = sum(1 for v in st.session_state.selected.values() if v)
+                    selected_count = int(st.session_state.selected_mask.sum())
                     st.markdown(f"**{selected_count}** selected")
                 
                 st.divider()
                 
-                for pii_type, items in by_type.items():
-                    is_premium_pattern = pii_type in PREMIUM_PATTERNS
-                    label = f"**{pii_type}** ({len(items)} found)"
+                for pii_type in unique_types[np.argsort(first_idx)]:
+                    idxs = np.flatnonzero(types == pii_type)
+                    is_premium_pattern = pii_type in PREMIUM_TYPES
+                    label = f"**{pii_type}** ({len(idxs)} found)"
                     if is_premium_pattern:
                         label += " ⭐"
                     
                     with st.expander(label, expanded=True):
-                        for idx, match in items:
+                        for idx in idxs:
+                            match = matches[idx]
                             col_a, col_b = st.columns([0.1, 0.9])
                             with col_a:
                                 checked = st.checkbox(
                                     "sel",
-                                    value=st.session_state.selected.get(idx, True),
+                                    value=bool(st.session_state.selected_mask[idx]),
                                     key=f"check_{idx}",
                                     label_visibility="hidden"
                                 )
-                                st.session_state.selected[idx] = checked
+                                st.session_state.selected_mask[idx] = checked
                             with col_b:
                                 st.markdown(f'`{match["text"]}` — Page {match["page"]}')
                 
                 st.divider()
                 
-                selected_items = [matches[i] for i, sel in st.session_state.selected.items() if sel]
+                selected_items = [matches[i] for i in np.flatnonzero(st.session_state.selected_mask)]
+                
+                optimize = st.checkbox("Optimize output size", help="Smaller file, but slower to save on large PDFs")
                 
                 if st.button(f"🔒 Redact {len(selected_items)} Selected Items", type="primary", disabled=len(selected_items)==0):
                     with st.spinner("Applying redactions..."):
-                        redacted_pdf = redact_pdf(pdf_bytes, selected_items)
+                        redacted_pdf = redact_pdf(pdf_bytes, selected_items, garbage_level=4 if optimize else 1)
                         st.session_state.redacted_pdf = redacted_pdf
                         st.success(f"✅ Redacted {len(selected_items)} items!")
                 
@@ -348,26 +405,36 @@ def show_redactor_app(is_premium=False, user=None):
             custom_text = st.text_input("Enter text to redact:", placeholder="Type exact text to find and redact...")
             
             if custom_text and st.button("Add to Redaction List"):
-                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-                found = False
-                for page_num_search, page in enumerate(doc):
-                    rects = page.search_for(custom_text)
-                    if rects:
-                        new_match = {
-                            "type": "Manual",
-                            "text": custom_text,
-                            "page": page_num_search + 1,
-                            "rects": rects
-                        }
-                        st.session_state.matches.append(new_match)
-                        st.session_state.selected[len(st.session_state.matches)-1] = True
-                        found = True
-                doc.close()
-                if found:
-                    st.success(f"Added '{custom_text}' to redaction list")
+                # search_for is case-insensitive and already returns every occurrence,
+                # so a repeat request just re-selects the entries it added before
+                manual_key = custom_text.casefold()
+                if manual_key in st.session_state.manual_texts:
+                    for i in st.session_state.manual_texts[manual_key]:
+                        st.session_state.selected_mask[i] = True
+                        # Drop the checkbox's widget state so it re-renders as checked
+                        st.session_state.pop(f"check_{i}", None)
                     st.rerun()
                 else:
-                    st.warning(f"Text '{custom_text}' not found in document")
+                    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+                    new_matches = []
+                    for page_num_search, page in enumerate(doc):
+                        rects = page.search_for(custom_text)
+                        if rects:
+                            new_matches.append({
+                                "type": "Manual",
+                                "text": custom_text,
+                                "page": page_num_search + 1,
+                                "rects": rects
+                            })
+                    doc.close()
+                    if new_matches:
+                        first_new = len(st.session_state.matches)
+                        _add_matches(new_matches)
+                        st.session_state.manual_texts[manual_key] = range(first_new, len(st.session_state.matches))
+                        st.success(f"Added '{custom_text}' to redaction list")
+                        st.rerun()
+                    else:
+                        st.warning(f"Text '{custom_text}' not found in document")
     
     else:
         # Instructions when no file uploaded
@@ -405,7 +472,7 @@ def show_redactor_app(is_premium=False, user=None):
             if not is_premium:
                 st.markdown("*Sign up in the Account tab to unlock premium detection.*")
 
-def show_account_tab():
+def show_account_tab(is_premium=False):
     """Display the account/signup tab"""
     
     if not PREMIUM_ENABLED:
@@ -415,8 +482,6 @@ def show_account_tab():
     # Check if user is logged in
     if "user" in st.session_state and st.session_state.user:
         user = st.session_state.user
-        tier = get_user_tier(user.id)
-        is_premium = tier == "premium"
         
         st.subheader(f"👤 {user.email}")
         
@@ -438,10 +503,16 @@ def show_account_tab():
                 if checkout_url:
                     st.markdown(f'<a href="{checkout_url}" target="_blank">Click here to complete payment</a>', unsafe_allow_html=True)
         
+        if st.button("🔄 Refresh subscription"):
+            get_user_tier.clear(user.id)
+            st.session_state.pop("tier", None)
+            st.rerun()
+        
         st.divider()
         if st.button("Logout"):
             supabase.auth.sign_out()
             del st.session_state.user
+            st.session_state.pop("tier", None)
             st.rerun()
     
     else:
@@ -462,6 +533,7 @@ def show_account_tab():
                         })
                         if res.user:
                             st.session_state.user = res.user
+                            st.session_state.pop("tier", None)
                             st.rerun()
                     except Exception as e:
                         st.error(f"Login failed: {str(e)}")
@@ -502,16 +574,18 @@ def main():
     # Check for payment success
     query_params = st.query_params
     if query_params.get("payment") == "success":
-        st.success("🎉 Payment successful! Your premium features are now active.")
+        st.success("🎉 Payment successful! Premium features switch on as soon as it's confirmed.")
         st.query_params.clear()
+        # Stripe's webhook updates the tier asynchronously, so it may still read free for a bit
+        st.session_state.upgrade_pending_until = time.time() + UPGRADE_PENDING_SECONDS
     
     # Check if user is logged in and premium
     is_premium = False
     user = None
     if "user" in st.session_state and st.session_state.user:
         user = st.session_state.user
-        tier = get_user_tier(user.id)
-        is_premium = tier == "premium"
+        # Looked up once per login rather than on every rerun
+        is_premium = load_user_tier(user.id) == "premium"
     
     # Tabs: Redactor and Account
     tab1, tab2 = st.tabs(["📄 Redactor", "👤 Account"])
@@ -520,12 +594,14 @@ def main():
         # Show premium status
         if is_premium:
             st.success("⭐ **Premium Features Active** — Address, Zip Code, and Credit Card detection enabled!")
+        elif user and upgrade_pending():
+            st.info("⏳ Confirming your payment — premium features will switch on shortly.")
         elif user:
             st.info("You're on the Free plan. Upgrade in the Account tab to unlock more detection patterns.")
         show_redactor_app(is_premium=is_premium, user=user)
     
     with tab2:
-        show_account_tab()
+        show_account_tab(is_premium=is_premium)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,316 @@
+"""
+PII detection for PDF Redactor: pattern matching and per-page scanning.
+Kept free of Streamlit so scan worker processes can import it.
+"""
+import fitz  # PyMuPDF
+import os
+import queue
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain, repeat
+
+# RE2 guarantees linear-time matching; fall back to the stdlib if it's missing
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+# Hyperscan (optional, x86 only) matches every pattern in one SIMD pass
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# PII patterns for detection
+PII_PATTERNS = {
+    "SSN (Full)": r"\b\d{3}-\d{2}-\d{4}\b",
+    "SSN (Partial)": r"\b[X*]{3,5}-?[X*]{2}-?\d{4}\b|\b\d{3}-?[X*]{2}-?[X*]{4}\b",
+    "SSN (Last 4)": r"\b(?:SSN|SS#?|Social)[\s:]*[X*]*\d{4}\b",
+    "Date of Birth": r"\b(?:DOB|Date of Birth|Birth Date|Born)[\s:]*\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b",
+    "Date (MM/DD/YYYY)": r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b",
+    "Driver's License": r"\b(?:DL|Driver'?s?\s*License|License\s*#?)[\s:]*[A-Z]?\d{6,12}\b",
+    "Phone Number": r"\b(?:\+?1[-.\s]?)?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}\b",
+    "Email": r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b",
+    "Account Number": r"\b(?:Account|Acct)[\s#:]*[X*]*\d{4,}\b|\b[X*]{4,}\d{4}\b",
+}
+
+# Premium-only patterns
+PREMIUM_PATTERNS = {
+    "Street Address": r"\b\d{1,5}\s+\w+\s+(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct|Way|Circle|Cir)\b",
+    "Zip Code": r"\b\d{5}(?:-\d{4})?\b",
+    "Credit Card": r"\b(?:\d{4}[-\s]?){3}\d{4}\b",
+}
+PREMIUM_TYPES = frozenset(PREMIUM_PATTERNS)
+
+# Each pattern is compiled once (inline (?i) since re2.compile takes an
+# Options object rather than flags). Patterns are matched independently, as
+# a single alternation would drop any match overlapping an earlier-starting one.
+_ALL_PATTERNS = list(PII_PATTERNS.items()) + list(PREMIUM_PATTERNS.items())
+_PATTERN_RANK = {name: i for i, (name, _) in enumerate(_ALL_PATTERNS)}
+_ALL_PATTERNS_COMPILED = [(name, re.compile("(?i)" + p)) for name, p in _ALL_PATTERNS]
+_FREE_PATTERNS_COMPILED = _ALL_PATTERNS_COMPILED[:len(PII_PATTERNS)]
+
+def _compile_hyperscan(patterns):
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[p.encode() for _, p in patterns],
+        ids=list(range(len(patterns))),
+        elements=len(patterns),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SOM_LEFTMOST] * len(patterns)
+    )
+    return db
+
+if hyperscan:
+    _FREE_COMBINED_HS_DB = _compile_hyperscan(_ALL_PATTERNS[:len(PII_PATTERNS)])
+    _ALL_COMBINED_HS_DB = _compile_hyperscan(_ALL_PATTERNS)
+    _hs_local = threading.local()
+
+def _hs_scratch(include_premium=False):
+    """Hyperscan scratch space can't be shared between threads, so each gets its own"""
+    attr = "premium" if include_premium else "free"
+    scratch = getattr(_hs_local, attr, None)
+    if scratch is None:
+        scratch = hyperscan.Scratch(_ALL_COMBINED_HS_DB if include_premium else _FREE_COMBINED_HS_DB)
+        setattr(_hs_local, attr, scratch)
+    return scratch
+
+def _regex_matches(pii_type, rx, text, pos=0):
+    """All non-overlapping matches of one pattern, from character offset pos"""
+    return [{
+        "type": pii_type,
+        "text": match.group(),
+        "start": match.start(),
+        "end": match.end()
+    } for match in rx.finditer(text, pos)]
+
+def _merge_overlaps(text, matches):
+    """Merge overlapping matches into one span each, typed by the longest match in it.
+    Merging rather than picking a winner keeps every matched character covered."""
+    merged = []
+    for m in sorted(matches, key=lambda m: (m["start"], _PATTERN_RANK[m["type"]])):
+        length = m["end"] - m["start"]
+        if merged and m["start"] < merged[-1]["end"]:
+            span = merged[-1]
+            span["end"] = max(span["end"], m["end"])
+            if length > span["longest"]:
+                span["type"], span["longest"] = m["type"], length
+        else:
+            merged.append({"type": m["type"], "start": m["start"], "end": m["end"], "longest": length})
+    return [{
+        "type": span["type"],
+        "text": text[span["start"]:span["end"]],
+        "start": span["start"],
+        "end": span["end"]
+    } for span in merged]
+
+def _find_pii_hyperscan(text, include_premium=False):
+    """find_pii_in_text on Hyperscan, giving the same matches as the regex path"""
+    db = _ALL_COMBINED_HS_DB if include_premium else _FREE_COMBINED_HS_DB
+    data = text.encode("utf-8")
+    
+    # Hyperscan reports every (start, end) a pattern can match; keep the longest per start
+    longest = {}
+    def on_match(pattern_id, start, end, flags, context):
+        if end > longest.get((pattern_id, start), -1):
+            longest[(pattern_id, start)] = end
+    db.scan(data, match_event_handler=on_match, scratch=_hs_scratch(include_premium))
+    
+    spans = defaultdict(list)
+    for (pattern_id, start), end in sorted(longest.items()):
+        spans[pattern_id].append((start, end))
+    
+    # Within each pattern, mirror finditer: leftmost match first, then resume after it.
+    # Patterns are ASCII-only, so byte offsets always fall on character boundaries.
+    to_char = (lambda i: i) if len(data) == len(text) else (lambda i: len(data[:i].decode("utf-8")))
+    matches = []
+    for pattern_id, pattern_spans in spans.items():
+        pii_type, rx = _ALL_PATTERNS_COMPILED[pattern_id]
+        pos = 0
+        for start, end in pattern_spans:
+            if start < pos:
+                if end > pos:
+                    # Only the leftmost start is reported per end, so a match beginning
+                    # inside this overlap could be hidden; let the regex finish the pattern
+                    matches.extend(_regex_matches(pii_type, rx, text, to_char(pos)))
+                    break
+                continue
+            pos = end
+            char_start = to_char(start)
+            match_text = data[start:end].decode("utf-8")
+            matches.append({
+                "type": pii_type,
+                "text": match_text,
+                "start": char_start,
+                "end": char_start + len(match_text)
+            })
+    return _merge_overlaps(text, matches)
+
+def _find_pii_regex(text, include_premium=False):
+    """Find all PII matches in text, one regex pass per pattern"""
+    patterns = _ALL_PATTERNS_COMPILED if include_premium else _FREE_PATTERNS_COMPILED
+    matches = []
+    for pii_type, rx in patterns:
+        matches.extend(_regex_matches(pii_type, rx, text))
+    return _merge_overlaps(text, matches)
+
+def find_pii_in_text(text, include_premium=False):
+    """Find all PII matches in text"""
+    if hyperscan:
+        return _find_pii_hyperscan(text, include_premium)
+    return _find_pii_regex(text, include_premium)
+
+def _words_to_text(words):
+    """Join page.get_text("words") output into plain text, recording each word's offsets"""
+    parts, starts, ends = [], [], []
+    pos = 0
+    prev_line = None
+    for w in words:
+        line = (w[5], w[6])
+        if parts:
+            parts.append(" " if line == prev_line else "\n")
+            pos += 1
+        starts.append(pos)
+        parts.append(w[4])
+        pos += len(w[4])
+        ends.append(pos)
+        prev_line = line
+    return "".join(parts), starts, ends
+
+def _scan_words(words, page_num, include_premium=False):
+    """Find all PII in a page's get_text("words") output. Each match lists the words
+    it covers; _finish_rects turns those into rects."""
+    text, starts, ends = _words_to_text(words)
+    matches = find_pii_in_text(text, include_premium)
+    for match in matches:
+        match["page"] = page_num + 1
+        # Rects come from the words the match overlaps, so there's no need to
+        # search the page again for the match text
+        first = bisect_right(ends, match["start"])
+        last = bisect_left(starts, match["end"])
+        covered = []
+        for i in range(first, last):
+            w = words[i]
+            if starts[i] >= match["start"] and ends[i] <= match["end"]:
+                covered.append(((w[5], w[6]), w[:4], None, 0))
+            else:
+                # The match covers only part of this word, e.g. the email in
+                # "Contact:jdoe@example.com"; note which occurrence of it in the word
+                lo = max(match["start"], starts[i]) - starts[i]
+                hi = min(match["end"], ends[i]) - starts[i]
+                fragment = w[4][lo:hi]
+                occurrence = w[4][:lo].casefold().count(fragment.casefold())
+                covered.append(((w[5], w[6]), w[:4], fragment, occurrence))
+        match["words"] = covered
+    return matches
+
+def _needs_page(matches):
+    return any(fragment is not None for m in matches for _, _, fragment, _ in m["words"])
+
+def _finish_rects(matches, page=None):
+    """Set each match's rects from its words, merged per line. Partly covered words are
+    trimmed to the matched characters with search_for, so page is only needed for those."""
+    for match in matches:
+        line_rects = {}
+        for line, word_rect, fragment, occurrence in match.pop("words"):
+            rect = fitz.Rect(word_rect)
+            if fragment is not None:
+                hits = page.search_for(fragment, clip=rect)
+                if len(hits) > occurrence:
+                    rect = hits[occurrence]
+            if line in line_rects:
+                line_rects[line].include_rect(rect)
+            else:
+                line_rects[line] = rect
+        match["rects"] = list(line_rects.values())
+    return matches
+
+def _scan_one_page(page, page_num, include_premium=False):
+    """Find all PII on a single page, with page number and rects filled in"""
+    return _finish_rects(_scan_words(page.get_text("words"), page_num, include_premium), page)
+
+def _extract_words(doc, pages, stop):
+    """Producer thread: queue each page's words, then None (or the error that stopped it).
+    Returns early once stop is set."""
+    try:
+        for page_num, page in enumerate(doc):
+            if stop.is_set():
+                return
+            pages.put((page_num, page.get_text("words")))
+        pages.put(None)
+    except Exception as e:
+        pages.put(e)
+
+def _drain(pages):
+    """Yield (page_num, words) from the producer's queue until it finishes"""
+    while (item := pages.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+# Document opened by each scan worker process (fitz.Document isn't picklable)
+_worker_doc = None
+
+def _open_worker_doc(pdf_bytes):
+    """Worker initializer: the PDF is sent once per worker rather than once per page"""
+    global _worker_doc
+    _worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+def _scan_page(page_num, include_premium=False):
+    """Worker entry point: scan one page of the worker's open document"""
+    return _scan_one_page(_worker_doc[page_num], page_num, include_premium)
+
+def _scan_threaded(doc, include_premium=False):
+    """Scan doc in this process, extracting text on a producer thread while this one
+    runs the regexes; only plain word tuples cross the queue"""
+    pages = queue.Queue(maxsize=4)
+    stop = threading.Event()
+    producer = threading.Thread(target=_extract_words, args=(doc, pages, stop), name="pii-extract", daemon=True)
+    producer.start()
+    try:
+        scanned = [(page_num, _scan_words(words, page_num, include_premium)) for page_num, words in _drain(pages)]
+    finally:
+        # If scanning raised, the producer may be blocked on a full queue:
+        # tell it to stop and keep draining until it exits
+        stop.set()
+        while producer.is_alive():
+            try:
+                pages.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        producer.join()
+    
+    # The producer is done with the document, so partly covered words can be trimmed here
+    return list(chain.from_iterable(
+        _finish_rects(matches, doc[page_num] if _needs_page(matches) else None)
+        for page_num, matches in scanned
+    ))
+
+def find_pii_in_pdf(pdf_bytes, include_premium=False, num_workers=None):
+    """Find all PII in a PDF document, spreading pages over worker processes"""
+    if num_workers is None:
+        num_workers = min(os.cpu_count() or 1, 4)
+    
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        if num_workers > 1 and doc.page_count > 1:
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=min(num_workers, doc.page_count),
+                    initializer=_open_worker_doc,
+                    initargs=(pdf_bytes,)
+                ) as executor:
+                    results = executor.map(_scan_page, range(doc.page_count), repeat(include_premium))
+                    return list(chain.from_iterable(results))
+            except (OSError, NotImplementedError, BrokenProcessPool):
+                # Worker processes can't run here (e.g. no /dev/shm for their locks),
+                # but there are cores to spare, so overlap extraction and matching instead
+                return _scan_threaded(doc, include_premium)
+        
+        return list(chain.from_iterable(
+            _scan_one_page(page, page_num, include_premium) for page_num, page in enumerate(doc)
+        ))
+    finally:
+        doc.close()
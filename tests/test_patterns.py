@@ -0,0 +1,41 @@
+"""PII pattern matching, checked on both the regex and Hyperscan backends"""
+import pytest
+
+import pii_scan
+
+BACKENDS = [
+    pii_scan._find_pii_regex,
+    pytest.param(
+        pii_scan._find_pii_hyperscan if pii_scan.hyperscan else None,
+        marks=pytest.mark.skipif(not pii_scan.hyperscan, reason="hyperscan not installed"),
+        id="hyperscan"
+    ),
+]
+
+
+def covered(matches):
+    return {(m["start"], m["end"], m["text"]) for m in matches}
+
+
+@pytest.mark.parametrize("find", BACKENDS)
+@pytest.mark.parametrize("text, include_premium, expected", [
+    # Overlapping matches are merged so every matched character stays covered
+    ("Text me at 5551234567@vtext.com", False, {(11, 31, "5551234567@vtext.com")}),
+    ("Call 800-555-1234 Main St", True, {(5, 25, "800-555-1234 Main St")}),
+    ("Acct 4111111111111111@bank.com", True, {(0, 30, "Acct 4111111111111111@bank.com")}),
+    ("DOB: 01/02/1990", False, {(0, 15, "DOB: 01/02/1990")}),
+])
+def test_overlapping_matches_keep_coverage(find, text, include_premium, expected):
+    assert covered(find(text, include_premium)) == expected
+
+
+@pytest.mark.parametrize("find", BACKENDS)
+def test_merged_span_takes_longest_type(find):
+    matches = find("DOB: 01/02/1990")
+    assert [m["type"] for m in matches] == ["Date of Birth"]
+
+
+@pytest.mark.parametrize("find", [pii_scan.find_pii_in_text, *BACKENDS])
+def test_email_tld_excludes_pipe(find):
+    assert not [m for m in find("foo@bar.a|a") if m["type"] == "Email"]
+    assert [m["text"] for m in find("foo@bar.ab") if m["type"] == "Email"] == ["foo@bar.ab"]
@@ -0,0 +1,134 @@
+"""Scanning whole PDFs: page numbers, rects, and the worker process pool"""
+import queue
+import sys
+import threading
+import time
+import types
+
+import fitz
+import pytest
+
+import pii_scan
+
+
+def make_pdf(*pages):
+    doc = fitz.open()
+    for lines in pages:
+        page = doc.new_page()
+        for i, line in enumerate(lines):
+            page.insert_text((72, 72 + 20 * i), line)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def summary(matches):
+    return [(m["page"], m["type"], m["text"], [tuple(r) for r in m["rects"]]) for m in matches]
+
+
+@pytest.fixture
+def multi_page_pdf():
+    return make_pdf(*([f"Mail jdoe{i}@example.com", "SSN 123-45-6789"] for i in range(6)))
+
+
+def test_worker_pool_matches_in_process_scan(multi_page_pdf):
+    pooled = pii_scan.find_pii_in_pdf(multi_page_pdf, num_workers=2)
+    assert summary(pooled) == summary(pii_scan.find_pii_in_pdf(multi_page_pdf, num_workers=1))
+    assert [m["page"] for m in pooled] == [p for p in range(1, 7) for _ in range(2)]
+
+
+def test_background_pool_scan_survives_streamlit_reruns(monkeypatch):
+    # Streamlit installs a fresh __main__ on every rerun (the scan-progress
+    # fragment reruns every 0.5s), so nothing the pool pickles may live there
+    pdf_bytes = make_pdf(*([f"Mail jdoe{i}@example.com"] for i in range(200)))
+    result = {}
+    def scan():
+        try:
+            result["matches"] = pii_scan.find_pii_in_pdf(pdf_bytes, num_workers=2)
+        except Exception as e:
+            result["error"] = e
+    worker = threading.Thread(target=scan)
+    worker.start()
+    while worker.is_alive():
+        monkeypatch.setitem(sys.modules, "__main__", types.ModuleType("__main__"))
+        worker.join(0.01)
+    assert "error" not in result
+    assert len(result["matches"]) == 200
+
+
+def no_pool(*args, **kwargs):
+    raise OSError("no worker processes here")
+
+
+def test_threaded_scan_when_pool_is_unavailable(monkeypatch, multi_page_pdf):
+    expected = summary(pii_scan.find_pii_in_pdf(multi_page_pdf, num_workers=1))
+    threaded = []
+    scan_threaded = pii_scan._scan_threaded
+    monkeypatch.setattr(pii_scan, "ProcessPoolExecutor", no_pool)
+    monkeypatch.setattr(pii_scan, "_scan_threaded", lambda *a: threaded.append(1) or scan_threaded(*a))
+    assert summary(pii_scan.find_pii_in_pdf(multi_page_pdf, num_workers=2)) == expected
+    assert threaded == [1]
+
+
+def test_threaded_scan_error_stops_producer_and_closes_doc(monkeypatch):
+    # More pages than the queue holds, so the producer is blocked when scanning fails
+    pdf_bytes = make_pdf(*([f"Mail jdoe{i}@example.com"] for i in range(20)))
+    opened = []
+    fitz_open = fitz.open
+    monkeypatch.setattr(fitz, "open", lambda *a, **k: opened.append(fitz_open(*a, **k)) or opened[-1])
+    monkeypatch.setattr(pii_scan, "ProcessPoolExecutor", no_pool)
+    queues = []
+    make_queue = queue.Queue
+    monkeypatch.setattr(queue, "Queue", lambda maxsize: queues.append(make_queue(maxsize)) or queues[-1])
+    def failing_scan_words(words, page_num, include_premium=False):
+        # Wait for the producer to fill the queue and block on its next put
+        deadline = time.monotonic() + 5
+        while not queues[-1].full() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        raise ValueError("boom")
+    monkeypatch.setattr(pii_scan, "_scan_words", failing_scan_words)
+    
+    with pytest.raises(ValueError, match="boom"):
+        pii_scan.find_pii_in_pdf(pdf_bytes, num_workers=2)
+    assert not any(t.name == "pii-extract" for t in threading.enumerate())
+    assert opened[-1].is_closed
+
+
+def scan_one_page(*lines):
+    return pii_scan.find_pii_in_pdf(make_pdf(lines), include_premium=True, num_workers=1)
+
+
+def x_after(prefix):
+    """x coordinate where prefix ends when written by make_pdf"""
+    return 72 + fitz.get_text_length(prefix, fontsize=11)
+
+
+@pytest.mark.parametrize("label, pii", [
+    ("Contact:", "jdoe@example.com"),
+    ("ID#", "123-45-6789"),
+])
+def test_rect_excludes_attached_label(label, pii):
+    [match] = scan_one_page(label + pii)
+    assert match["text"] == pii
+    [rect] = match["rects"]
+    assert rect.x0 == pytest.approx(x_after(label), abs=0.5)
+    assert rect.x1 == pytest.approx(x_after(label + pii), abs=0.5)
+
+
+def test_repeated_fragment_in_one_word_gets_each_occurrence():
+    first, second = scan_one_page("123-45-6789/123-45-6789")
+    assert first["rects"][0].x0 == pytest.approx(72, abs=0.5)
+    assert first["rects"][0].x1 == pytest.approx(x_after("123-45-6789"), abs=0.5)
+    assert second["rects"][0].x0 == pytest.approx(x_after("123-45-6789/"), abs=0.5)
+    assert second["rects"][0].x1 == pytest.approx(x_after("123-45-6789/123-45-6789"), abs=0.5)
+
+
+def test_match_wrapping_onto_next_line_gets_a_rect_per_line():
+    [match] = scan_one_page("Patient DOB:", "01/02/1990 on file")
+    assert match["type"] == "Date of Birth"
+    top, bottom = sorted(match["rects"], key=lambda r: r.y0)
+    assert top.x0 == pytest.approx(x_after("Patient "), abs=0.5)
+    assert top.x1 == pytest.approx(x_after("Patient DOB:"), abs=0.5)
+    assert bottom.x0 == pytest.approx(72, abs=0.5)
+    assert bottom.x1 == pytest.approx(x_after("01/02/1990"), abs=0.5)
+    assert bottom.y0 > top.y1 - 1